@@ -1,25 +1,31 @@
+import json
 import os
-import tempfile
-import subprocess
-import shutil
+import queue
+import threading
+import atexit
+import functools
+import io
 import logging
+import zlib
 from logging.handlers import RotatingFileHandler
 from datetime import datetime
-from xml.etree import ElementTree as ET
-from flask import Flask, request, jsonify, send_file
+try:
+    # libxml2-backed parser, noticeably faster than the stdlib one; the
+    # subset of the ElementTree API we use is identical in both.
+    from lxml import etree as ET
+except ImportError:
+    from xml.etree import ElementTree as ET
+from flask import Flask, request, jsonify, Response, stream_with_context
 import paramiko
-from dateutil import parser as dateparser
 
 # ==========================================================
 # CONFIG
 # ==========================================================
 XML_PATH = "config.xml"
 SSH_KEY_PATH = os.path.expanduser("~/.ssh/id_rsa")  # change if needed
-TEMP_DIR = "temp_downloads"
 LOG_DIR = "logs"
-MAX_ZIP_MB = 20  # Zip logs larger than this (in MB)
+MAX_ZIP_MB = 20  # Gzip logs larger than this (in MB)
 
-os.makedirs(TEMP_DIR, exist_ok=True)
 os.makedirs(LOG_DIR, exist_ok=True)
 
 # ==========================================================
@@ -27,12 +33,24 @@ os.makedirs(LOG_DIR, exist_ok=True)
 # ==========================================================
 app = Flask(__name__)
 
+class BufferedRotatingFileHandler(RotatingFileHandler):
+    """RotatingFileHandler with a larger write buffer to cut syscalls."""
+
+    def _open(self):
+        return open(self.baseFilename, self.mode, encoding=self.encoding,
+                    buffering=io.DEFAULT_BUFFER_SIZE * 8)
+
+
 # Rotating log file: keeps console clean & saves logs persistently
 LOG_FILE = os.path.join(LOG_DIR, "app.log")
-handler = RotatingFileHandler(LOG_FILE, maxBytes=10_000_000, backupCount=5)
+handler = BufferedRotatingFileHandler(LOG_FILE, maxBytes=5_000_000, backupCount=2)
+atexit.register(handler.flush)
 formatter = logging.Formatter("%(asctime)s [%(levelname)s] %(name)s: %(message)s")
 handler.setFormatter(formatter)
 
+# Drop any handlers installed by a previous import of this module so a
+# re-import doesn't write every record twice.
+app.logger.handlers.clear()
 app.logger.addHandler(handler)
 app.logger.setLevel(logging.INFO)
 logging.getLogger("werkzeug").setLevel(logging.WARNING)
@@ -43,8 +61,18 @@ log = app.logger
 # ==========================================================
 # UTILS
 # ==========================================================
+# Cache of parsed config keyed by file mtime, so repeated requests don't
+# re-parse the XML. Invalidates automatically when config.xml is edited.
+_CFG_CACHE = {}  # path -> (st_mtime_ns, projects_dict, project_names)
+
+
 def parse_xml():
-    """Parse config.xml to extract projects and modules."""
+    """Parse config.xml to extract projects and modules (cached by mtime)."""
+    mtime_ns = os.stat(XML_PATH).st_mtime_ns
+    cached = _CFG_CACHE.get(XML_PATH)
+    if cached and cached[0] == mtime_ns:
+        return cached[1]
+
     tree = ET.parse(XML_PATH)
     root = tree.getroot()
     projects = {}
@@ -57,12 +85,34 @@ def parse_xml():
                 "path": m.get("path"),
                 "base": m.get("base"),
                 "server": m.get("host") or m.get("server"),
-                "user": m.get("user")
+                "user": m.get("user"),
+                "key": m.get("key")
             }
         projects[pname] = modules
+
+    _CFG_CACHE[XML_PATH] = (mtime_ns, projects, list(projects.keys()))
     return projects
 
 
+_DATE_FORMATS = ("%Y-%m-%d", "%d-%m-%Y", "%Y/%m/%d", "%d/%m/%Y")
+
+
+def parse_request_date(date_str):
+    """Parse a user-supplied date against the documented formats only."""
+    for fmt in _DATE_FORMATS:
+        try:
+            return datetime.strptime(date_str, fmt).date()
+        except ValueError:
+            pass
+    raise ValueError("Invalid date format. Use YYYY-MM-DD or DD-MM-YYYY.")
+
+
+def project_names():
+    """Return the cached list of project names without rebuilding it."""
+    parse_xml()
+    return _CFG_CACHE[XML_PATH][2]
+
+
 def get_module_config(project, module):
     projects = parse_xml()
     if project not in projects:
@@ -73,103 +123,231 @@ def get_module_config(project, module):
 # ==========================================================
 # SSH HELPERS
 # ==========================================================
+@functools.lru_cache(maxsize=8)
+def _load_pkey(pkey_path, mtime_ns):
+    # mtime_ns is part of the key purely to invalidate on key rotation.
+    return paramiko.RSAKey.from_private_key_file(pkey_path)
+
+
 def _get_pkey_object(pkey_path):
+    """Load an RSA key, reusing the parsed object until the file changes."""
     if not pkey_path:
         return None
     try:
-        return paramiko.RSAKey.from_private_key_file(pkey_path)
+        return _load_pkey(pkey_path, os.stat(pkey_path).st_mtime_ns)
     except Exception as e:
         log.warning("Unable to load private key from %s: %s", pkey_path, e)
         return None
 
 
-def ssh_run_command(host, command, username=None, pkey_path=None, timeout=30):
+def sftp_connect(host, username=None, pkey_path=None, timeout=30):
+    """Open one SSH connection and return (sftp, client).
+
+    Caller is responsible for closing the client, which tears down the
+    SFTP channel and transport with it.
+    """
     client = paramiko.SSHClient()
     client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
     pkey = _get_pkey_object(pkey_path)
-
-    try:
-        if pkey:
-            log.info("SSH connect -> host=%s user=%s key=%s", host, username, pkey_path)
-            client.connect(hostname=host, username=username, pkey=pkey, timeout=timeout)
-        else:
-            log.info("SSH connect (agent/keys lookup) -> host=%s user=%s", host, username)
-            client.connect(hostname=host, username=username,
-                           allow_agent=True, look_for_keys=True, timeout=timeout)
-        stdin, stdout, stderr = client.exec_command(command)
-        out = stdout.read().decode().strip()
-        err = stderr.read().decode().strip()
-        return out, err
-    finally:
+    if pkey:
+        log.info("SFTP connect -> host=%s user=%s key=%s", host, username, pkey_path)
+        client.connect(hostname=host, username=username, pkey=pkey, timeout=timeout)
+    else:
+        log.info("SFTP connect (agent/keys lookup) -> host=%s user=%s", host, username)
+        client.connect(hostname=host, username=username,
+                       allow_agent=True, look_for_keys=True, timeout=timeout)
+    sftp = client.open_sftp()
+    return sftp, client
+
+
+class PoolExhaustedError(Exception):
+    """Raised when no pooled connection frees up within the wait window."""
+
+
+class SFTPPool:
+    """Bounded pool of authenticated SSH connections keyed by (host, user).
+
+    Reusing a connection skips the SSH handshake entirely and keeps the
+    number of concurrent transports per host below sshd's MaxStartups.
+    Idle connections are health-checked on acquire and rebuilt if dead.
+    """
+
+    def __init__(self, max_per_key=4):
+        self.max_per_key = max_per_key
+        self._idle = {}
+        self._sems = {}
+        self._lock = threading.Lock()
+
+    def _sem(self, key):
+        with self._lock:
+            sem = self._sems.get(key)
+            if sem is None:
+                sem = self._sems[key] = threading.BoundedSemaphore(self.max_per_key)
+            return sem
+
+    def _queue(self, key):
+        with self._lock:
+            q = self._idle.get(key)
+            if q is None:
+                q = self._idle[key] = queue.Queue(self.max_per_key)
+            return q
+
+    def acquire(self, host, username=None, pkey_path=None, timeout=30, wait=30):
+        """Return a live (sftp, client) pair, reusing an idle one if possible.
+
+        Blocks up to `wait` seconds for a free slot, then raises
+        PoolExhaustedError rather than hanging the caller forever.
+        """
+        key = (host, username)
+        if not self._sem(key).acquire(timeout=wait):
+            raise PoolExhaustedError(
+                f"all {self.max_per_key} SFTP connections for {host} busy "
+                f"after {wait}s")
+        idle = self._queue(key)
+        while True:
+            try:
+                sftp, client = idle.get_nowait()
+            except queue.Empty:
+                break
+            transport = client.get_transport()
+            try:
+                if transport and transport.is_active():
+                    sftp.stat(".")  # cheap round-trip to prove the channel works
+                    return sftp, client
+            except Exception:
+                pass
+            self._close(sftp, client)
         try:
-            client.close()
+            return sftp_connect(host, username=username,
+                                pkey_path=pkey_path, timeout=timeout)
         except Exception:
-            pass
+            self._sem(key).release()
+            raise
+
+    def release(self, host, username, sftp, client, broken=False):
+        """Return a connection to the pool, or close it if it misbehaved."""
+        key = (host, username)
+        transport = client.get_transport()
+        if broken or transport is None or not transport.is_active():
+            self._close(sftp, client)
+        else:
+            try:
+                self._queue(key).put_nowait((sftp, client))
+            except queue.Full:
+                self._close(sftp, client)
+        self._sem(key).release()
 
+    @staticmethod
+    def _close(sftp, client):
+        for obj in (sftp, client):
+            try:
+                obj.close()
+            except Exception:
+                pass
 
-def sftp_get(host, remote_path, local_path, username=None, pkey_path=None, timeout=30):
-    try:
-        if pkey_path:
-            pkey = _get_pkey_object(pkey_path)
-            transport = paramiko.Transport((host, 22))
-            transport.connect(username=username, pkey=pkey)
-            sftp = paramiko.SFTPClient.from_transport(transport)
-            sftp.get(remote_path, local_path)
-            sftp.close()
-            transport.close()
-        else:
-            client = paramiko.SSHClient()
-            client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-            client.connect(hostname=host, username=username, allow_agent=True,
-                           look_for_keys=True, timeout=timeout)
-            sftp = client.open_sftp()
-            sftp.get(remote_path, local_path)
-            sftp.close()
-            client.close()
-    except Exception as e:
-        log.exception("sftp_get failed: %s", e)
-        raise
+
+SFTP_POOL = SFTPPool()
+
+
+def _gzip_chunks(chunks, compresslevel=1):
+    """Gzip-compress an iterable of byte chunks on the fly.
+
+    Level 1 trades a little ratio for ~3x the throughput, which is the
+    right call when compression runs inline with the response. No
+    separate worker pool is needed: zlib releases the GIL while it
+    compresses each chunk, so other WSGI threads keep serving requests
+    during the CPU-heavy part.
+    """
+    comp = zlib.compressobj(compresslevel, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = comp.compress(chunk)
+        if data:
+            yield data
+    yield comp.flush()
 
 
 # ==========================================================
 # CORE FUNCTIONALITY
 # ==========================================================
-def find_latest_log_via_ls(host, dirpath, base, include_gz=True, date_str=None, username=None):
-    """Find log file on remote host by date or latest."""
+def sftp_find_latest_log(sftp, dirpath, base, date_str=None):
+    """Find log file in a remote directory over an existing SFTP channel."""
     if date_str:
-        try:
-            d = dateparser.parse(date_str, settings={'DATE_ORDER': 'DMY'}).date()
-            date_part = d.strftime("%d-%m-%Y")
-        except Exception:
-            raise ValueError("Invalid date format. Use YYYY-MM-DD or DD-MM-YYYY.")
-        pattern = f"{base}-{date_part}.log*"
-        cmd = f"ls -1 {os.path.join(dirpath, pattern)} 2>/dev/null | head -1"
-    else:
-        pattern = f"{base}*.log*"
-        cmd = f"ls -t {os.path.join(dirpath, pattern)} 2>/dev/null | head -1"
+        date_part = parse_request_date(date_str).strftime("%d-%m-%Y")
+        prefix = f"{base}-{date_part}.log"
 
-    log.debug(f"DEBUG CMD: {cmd} | HOST: {host} | USER: {username}")
-    out, err = ssh_run_command(host, cmd, username=username)
-    if err and not out:
+        def match(name):
+            return name.startswith(prefix)
+    else:
+        def match(name):
+            return name.startswith(base) and ".log" in name
+
+    # listdir_iter pipelines batches of READDIR requests and yields
+    # attributes as they arrive, so the filter+argmax pass runs in O(1)
+    # memory even for directories with years of rotated logs.
+    attrs = sftp.listdir_iter(dirpath, read_aheads=50)
+    best = max((a for a in attrs if match(a.filename)),
+               key=lambda a: a.st_mtime, default=None)
+    if best is None:
         return None
-    return out.strip() if out else None
+    return os.path.join(dirpath, best.filename)
 
 
 # ==========================================================
 # ROUTES
 # ==========================================================
+# Serialized response bodies keyed to the config mtime, so the listing
+# routes skip JSON serialization entirely on repeat requests.
+_PROJECTS_JSON = None  # (mtime_ns, body_bytes)
+_MODULES_JSON = (0, {})  # (mtime_ns, {project: body_bytes})
+
+
 @app.route("/projects", methods=["GET"])
 def list_projects():
-    projects = parse_xml()
-    return jsonify({"projects": list(projects.keys())})
+    global _PROJECTS_JSON
+    mtime_ns = os.stat(XML_PATH).st_mtime_ns
+    if _PROJECTS_JSON is None or _PROJECTS_JSON[0] != mtime_ns:
+        body = json.dumps({"projects": project_names()}).encode()
+        _PROJECTS_JSON = (mtime_ns, body)
+    return Response(_PROJECTS_JSON[1], mimetype="application/json")
 
 
 @app.route("/modules/<project>", methods=["GET"])
 def list_modules(project):
-    projects = parse_xml()
-    if project not in projects:
-        return jsonify({"modules": []}), 404
-    return jsonify({"modules": list(projects[project].keys())})
+    global _MODULES_JSON
+    mtime_ns = os.stat(XML_PATH).st_mtime_ns
+    gen, cache = _MODULES_JSON
+    if gen != mtime_ns:
+        cache = {}
+        _MODULES_JSON = (mtime_ns, cache)
+    body = cache.get(project)
+    if body is None:
+        projects = parse_xml()
+        if project not in projects:
+            return jsonify({"modules": []}), 404
+        body = json.dumps({"modules": list(projects[project].keys())}).encode()
+        cache[project] = body
+    return Response(body, mimetype="application/json")
+
+
+@app.route("/log", methods=["GET"])
+def tail_app_log():
+    """Return the tail of the application log, bounded to the last 1 MiB."""
+    limit = 1 << 20
+    try:
+        with open(LOG_FILE, "rb") as f:
+            f.seek(0, os.SEEK_END)
+            size = f.tell()
+            f.seek(max(0, size - limit))
+            data = f.read()
+    except FileNotFoundError:
+        return Response("", mimetype="text/plain")
+
+    if size > limit:
+        # The first line is almost certainly cut mid-record; drop it.
+        nl = data.find(b"\n")
+        if nl != -1:
+            data = data[nl + 1:]
+    return Response(data, mimetype="text/plain")
 
 
 @app.route("/download", methods=["GET"])
@@ -189,51 +367,122 @@ def download_log():
     host = mod_cfg.get("server")
     dirpath = mod_cfg.get("path")
     base = mod_cfg.get("base")
+    pkey_path = mod_cfg.get("key")
+
+    # Validate the date before any SSH work so malformed input gets its
+    # 400 without costing a pool slot and a handshake.
+    if date:
+        try:
+            parse_request_date(date)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
 
     log.info("Request for download: project=%s module=%s host=%s date=%s", project, module, host, date)
     log.info("Resolved SSH username=%s", username)
 
+    # One SSH connection serves both the directory listing and the file
+    # transfer; the pool lets repeat requests skip the handshake entirely.
     try:
-        remote_file = find_latest_log_via_ls(host, dirpath, base, date_str=date, username=username)
-    except ValueError as e:
-        return jsonify({"error": str(e)}), 400
+        sftp, client = SFTP_POOL.acquire(host, username=username,
+                                         pkey_path=pkey_path)
+    except PoolExhaustedError as e:
+        log.warning("SFTP pool exhausted: %s", e)
+        return jsonify({"error": str(e)}), 503
     except Exception as e:
-        log.exception("Error finding log")
-        return jsonify({"error": f"error finding log: {e}"}), 500
+        log.exception("SFTP connect failed")
+        return jsonify({"error": f"failed to connect: {e}"}), 500
 
-    if not remote_file:
-        return jsonify({"error": "no matching log file found on server"}), 404
+    broken = False
+    streaming = False
+    try:
+        try:
+            remote_file = sftp_find_latest_log(sftp, dirpath, base, date_str=date)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        except Exception as e:
+            log.exception("Error finding log")
+            broken = True
+            return jsonify({"error": f"error finding log: {e}"}), 500
 
-    filename = os.path.basename(remote_file)
-    local_temp = os.path.join(TEMP_DIR, f"{datetime.utcnow().timestamp()}_{filename}")
+        if not remote_file:
+            return jsonify({"error": "no matching log file found on server"}), 404
 
-    try:
-        sftp_get(host, remote_file, local_temp, username=username)
-    except Exception as e:
-        log.exception("SFTP download failed")
-        return jsonify({"error": f"failed to download log: {e}"}), 500
-
-    filesize = os.path.getsize(local_temp)
-    if filesize > MAX_ZIP_MB * 1024 * 1024:
-        zip_path = shutil.make_archive(local_temp, 'zip',
-                                       root_dir=os.path.dirname(local_temp),
-                                       base_dir=os.path.basename(local_temp))
-        os.remove(local_temp)
-        to_send = zip_path
-    else:
-        to_send = local_temp
+        filename = os.path.basename(remote_file)
 
-    log.info("Served file %s to client %s for %s/%s", os.path.basename(to_send),
-             request.remote_addr, project, module)
+        try:
+            filesize = sftp.stat(remote_file).st_size
+        except Exception as e:
+            log.exception("Error stating log")
+            broken = True
+            return jsonify({"error": f"error reading log: {e}"}), 500
+
+        # Stream the remote file straight into the response: no temp
+        # file, no second read from disk, no cleanup race. The pooled
+        # connection is released when the response finishes.
+        try:
+            fh = sftp.open(remote_file, "rb")
+            fh.prefetch()
+        except Exception as e:
+            log.exception("SFTP open failed")
+            broken = True
+            return jsonify({"error": f"failed to open log: {e}"}), 500
+
+        # The generator's finally only runs if the body is iterated at
+        # least once; Werkzeug never iterates the body of a HEAD response
+        # (Flask auto-adds HEAD to GET routes) and a client can disconnect
+        # before the first byte. call_on_close runs in every case, so the
+        # release lives in an idempotent closure invoked from both paths.
+        finished = threading.Event()
+
+        def _finish(stream_broken=False):
+            if finished.is_set():
+                return
+            finished.set()
+            try:
+                fh.close()
+            except Exception:
+                stream_broken = True
+            SFTP_POOL.release(host, username, sftp, client,
+                              broken=stream_broken)
+
+        def _stream():
+            stream_broken = False
+            try:
+                while True:
+                    chunk = fh.read(1 << 20)
+                    if not chunk:
+                        break
+                    yield chunk
+            except Exception:
+                stream_broken = True
+                raise
+            finally:
+                _finish(stream_broken)
+
+        if filesize > MAX_ZIP_MB * 1024 * 1024:
+            # Compress on the fly while streaming; no zip written to disk
+            # and compression overlaps with the network send.
+            body = _gzip_chunks(_stream())
+            mimetype = "application/gzip"
+            headers = {"Content-Disposition": f"attachment; filename={filename}.gz"}
+        else:
+            body = _stream()
+            mimetype = "application/octet-stream"
+            headers = {
+                "Content-Disposition": f"attachment; filename={filename}",
+                "Content-Length": str(filesize),
+            }
 
-    try:
-        return send_file(to_send, as_attachment=True)
+        log.info("Streaming file %s (%d bytes) to client %s for %s/%s", filename,
+                 filesize, request.remote_addr, project, module)
+        streaming = True
+        resp = Response(stream_with_context(body), mimetype=mimetype,
+                        headers=headers)
+        resp.call_on_close(_finish)
+        return resp
     finally:
-        try:
-            if os.path.exists(to_send):
-                os.remove(to_send)
-        except Exception:
-            log.exception("Error cleaning up temp file")
+        if not streaming:
+            SFTP_POOL.release(host, username, sftp, client, broken=broken)
 
 
 # ==========================================================
@@ -0,0 +1,11 @@
+"""WSGI entry point for production servers.
+
+Run with threaded workers so concurrent /download requests can overlap
+their (blocking) SFTP I/O and the connection pool actually gets reused:
+
+    gunicorn -k gthread -w 4 --threads 16 -b 0.0.0.0:5000 wsgi:app
+"""
+from app import app
+
+if __name__ == "__main__":
+    app.run()